@@ -15,16 +15,14 @@ Market Data Criteria:
 3. Volume patterns
 4. Recent price movements
 
-{strategy_context}
-
 Respond in this exact format:
 1. First line must be one of: BUY, SELL, or NOTHING (in caps)
-2. Then explain your reasoning, including:
+2. Second line must be your confidence level as a percentage (e.g. Confidence: 75%)
+3. Then briefly explain your reasoning in a few short sentences, covering:
    - Technical analysis
    - Strategy signals analysis (if available)
    - Risk factors
    - Market conditions
-   - Confidence level (as a percentage, e.g. 75%)
 
 Remember: 
 - Coffee AI always prioritizes risk management! 🛡️
@@ -33,54 +31,139 @@ Remember:
 """
 
 ALLOCATION_PROMPT = """
-You are Coffee AI's Portfolio Allocation Assistant 
-
-Given the total portfolio size and trading recommendations, allocate capital efficiently.
-Consider:
-1. Position sizing based on confidence levels
-2. Risk distribution
-3. Keep cash buffer as specified
-4. Maximum allocation per position
-
-Format your response as a Python dictionary:
-{
-    "token_address": allocated_amount,  # In USD
-    ...
-    "USDC_ADDRESS": remaining_cash  # Always use USDC_ADDRESS for cash
-}
-
-Remember:
-- Total allocations must not exceed total_size
-- Higher confidence should get larger allocations
-- Never allocate more than {MAX_POSITION_PERCENTAGE}% to a single position
-- Keep at least {CASH_PERCENTAGE}% in USDC as safety buffer
-- Only allocate to BUY recommendations
-- Cash must be stored as USDC using USDC_ADDRESS: {USDC_ADDRESS}
+You are Coffee AI's Portfolio Allocation AI
+
+Provide a portfolio allocation that:
+1. Never exceeds max position size per token
+2. Maintains minimum cash (USDC) buffer of {CASH_PERCENTAGE}%
+3. Returns allocation as a JSON object with token addresses as keys and USD amounts as values
+4. Uses exact USDC address: {USDC_ADDRESS} for cash allocation
+
+Say I had $10 in USDC
+Example format:
+{{
+    "token_address": 1.5,
+    "{USDC_ADDRESS}": 8.5
+}}
 """
 
+import asyncio
 import enum
 import functools
+import glob
+import hashlib
 import json
 import os
+import re
 import threading
 import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from traceback import print_exc
 
 import anthropic
+import httpx
+import json_repair
+import orjson
+import numpy as np
 import pandas as pd
+from anthropic.types import TextBlock
 from dotenv import load_dotenv
+from tenacity import (
+    retry,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_exponential,
+)
 
 from src import nice_funcs as n
 
 # Local imports
 from src.config import *
-from src.data.ohlcv_collector import collect_all_tokens, get_wallet_owned_tokens
+from src.data.ohlcv_collector import (
+    collect_all_tokens,
+    get_wallet_owned_tokens,
+    ohlcv_arrays,
+    summarize_ohlcv,
+)
 
 # Load environment variables
 load_dotenv()
 mutex = threading.Lock()
 
+RECOMMENDATION_COLUMNS = ["token", "action", "confidence", "reasoning", "status"]
+NO_STRATEGY_CONTEXT = "No strategy signals available."
+
+# First line of an analysis is the action in caps, possibly numbered like the
+# prompt's format list, wrapped in markdown or behind a label ("1. BUY",
+# "**SELL**", "Recommendation: BUY"); confidence is given as a percentage
+ACTION_RE = re.compile(
+    r"[\s*_#>`]*(?:\d+[.)][\s*_`]*)?(?:[A-Za-z ]+:[\s*_`]*)?(BUY|SELL|NOTHING)\b"
+)
+CONFIDENCE_RE = re.compile(r"confidence[^0-9\n]*(\d{1,3})", re.IGNORECASE)
+
+
+class AnthropicLimiter:
+    """Requests-per-minute and tokens-per-minute buckets shared by all Claude calls"""
+
+    def __init__(self, rpm=AI_REQUESTS_PER_MINUTE, tpm=AI_TOKENS_PER_MINUTE):
+        self.requests = n.TokenBucket(rpm)
+        self.tokens = n.TokenBucket(tpm)
+
+    @staticmethod
+    def estimate_tokens(params):
+        """Rough input token count for a request, at ~4 characters per token"""
+        text = json.dumps(params.get("system", "")) + json.dumps(params["messages"])
+        return len(text) // 4
+
+    async def acquire(self, params):
+        """Wait until the request fits within both rate limits"""
+        await self.requests.acquire_async()
+        await self.tokens.acquire_async(self.estimate_tokens(params))
+
+
+anthropic_limiter = AnthropicLimiter()
+
+
+def response_text(content):
+    """Join the text of a Claude response's content blocks into one string"""
+    if isinstance(content, list):
+        return "\n".join(
+            [item.text if hasattr(item, "text") else str(item) for item in content]
+        )
+    return str(content)
+
+
+def last_close_and_volume(market_data):
+    """Latest candle's close and volume, or None if the data doesn't have them"""
+    close = market_data.get("close")
+    volume = market_data.get("volume")
+    if close is None or volume is None or not len(close):
+        return None
+    return float(close[-1]), float(volume[-1])
+
+
+def _quantize(value):
+    """Round floats to 4 significant digits (~0.1%) so tiny moves share a cache key"""
+    if isinstance(value, np.ndarray):
+        return _quantize(value.tolist())
+    if isinstance(value, dict):
+        return {str(k): _quantize(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_quantize(v) for v in value]
+    if isinstance(value, float):
+        return float(f"{value:.4g}")
+    return value
+
+
+def market_data_fingerprint(token, market_data):
+    """Hash a token and its quantized market data into a response cache key"""
+    payload = json.dumps(
+        {"t": token, "md": _quantize(market_data)}, sort_keys=True, default=str
+    )
+    return hashlib.sha1(payload.encode()).hexdigest()
+
 
 def run_in_thread(func):
     """Decorator to run a function in a separate thread."""
@@ -94,6 +177,23 @@ def run_in_thread(func):
     return wrapper
 
 
+def cached_system_prompt(text):
+    """Wrap a static prompt as a system block eligible for Anthropic prompt caching.
+
+    Blocks shorter than the model's minimum cacheable length (1024 tokens for
+    Sonnet, 2048 for Haiku) are sent as usual but not cached.
+    """
+    return [{"type": "text", "text": text, "cache_control": {"type": "ephemeral"}}]
+
+
+# System blocks are static, so build them once. Both prompts are currently
+# well under the minimum cacheable length, so they are not actually cached yet
+TRADING_SYSTEM = cached_system_prompt(TRADING_PROMPT)
+ALLOCATION_SYSTEM = cached_system_prompt(
+    ALLOCATION_PROMPT.format(CASH_PERCENTAGE=CASH_PERCENTAGE, USDC_ADDRESS=USDC_ADDRESS)
+)
+
+
 class AgentStatus(enum.Enum):
     INITIALIZED = "initialized"
     TRADING = "trading"
@@ -102,76 +202,372 @@ class AgentStatus(enum.Enum):
 
 class TradingAgent:
     tid: threading.Thread = None
-    __stop = False
 
     def stop(self):
-        if self.tid:
-            self.__stop = True
+        # Wakes the trading loop immediately, even mid-sleep
+        self._stop_event.set()
+        # Let a cycle in progress finish, so a new agent for the same run
+        # never appends to the run's files alongside this one
+        if self.tid and self.tid is not threading.current_thread():
+            self.tid.join()
+        # Snapshot for anyone who wants the recommendations as a plain CSV
+        self.recommendations_df.to_csv(
+            f"runs/{self.run_id}_recommendations_latest.csv", index=False
+        )
+        with mutex:
+            self._recommendations_fp.close()
+            self._log_fp.close()
 
     def __init__(self, run_id):
         self.setup(run_id)
 
     def setup(self, run_id):
         self.run_id = run_id
+        self._stop_event = threading.Event()
         self.status = AgentStatus.INITIALIZED
-        self.client = anthropic.Anthropic(api_key=os.getenv("ANTHROPIC_KEY"))
+        self.api_key = os.getenv("ANTHROPIC_KEY")
+        self._clients = weakref.WeakKeyDictionary()
+        self._monitored_tokens_cache = (0, None, [])
+        self._response_cache = {}
+        self._last_features = {}
+        self._cycle_features = {}
+        self._signals_dump_cache = {}
+        self._last_cleanup_mtime = None
         self.logs = []
-        if os.path.exists(f"runs/{self.run_id}_logs.json"):
+        log_file = f"runs/{self.run_id}_logs.jsonl"
+        legacy_logs = []
+        if os.path.exists(log_file):
+            with open(log_file, "rb") as f:
+                self.logs = [orjson.loads(line) for line in f if line.strip()]
+        elif os.path.exists(f"runs/{self.run_id}_logs.json"):
             with open(f"runs/{self.run_id}_logs.json", "r") as f:
-                self.logs = json.load(f)
-
-        if os.path.exists(f"runs/{self.run_id}_recommendations_latest.csv"):
+                legacy_logs = self.logs = json.load(f)
+
+        # Logs are appended one JSON line at a time instead of rewriting the file
+        os.makedirs("runs", exist_ok=True)
+        # Unbuffered, so each entry lands in the file with a single write
+        self._log_fp = open(log_file, "ab", buffering=0)
+        for entry in legacy_logs:
+            self._append_log(entry)
+
+        # Recommendations are appended as JSON lines keyed by row; a status
+        # change re-appends the row and the last line for each row wins
+        self._pending_rows = []
+        # Bumped on every change, so the API's JSON is only rebuilt when needed
+        self._rec_version = 0
+        self._rec_cache = None
+        self._rec_cache_lock = threading.Lock()
+        recommendations_file = f"runs/{self.run_id}_recommendations.jsonl"
+        legacy_recommendations = False
+        if os.path.exists(recommendations_file):
+            records = {}
+            with open(recommendations_file, "r") as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        records[record.pop("row")] = record
+            self.recommendations_df = pd.DataFrame(
+                [records[row] for row in sorted(records)],
+                columns=RECOMMENDATION_COLUMNS,
+            )
+        elif os.path.exists(f"runs/{self.run_id}_recommendations_latest.csv"):
             self.recommendations_df = pd.read_csv(
                 f"runs/{self.run_id}_recommendations_latest.csv"
             )
+            legacy_recommendations = True
         else:
-            self.recommendations_df = pd.DataFrame(
-                columns=["token", "action", "confidence", "reasoning", "status"]
-            )
+            self.recommendations_df = pd.DataFrame(columns=RECOMMENDATION_COLUMNS)
+
+        self._recommendations_fp = open(recommendations_file, "a", buffering=1)
+        if legacy_recommendations:
+            self._save_recommendations(self.recommendations_df.index)
         self.log("🤖 Coffee AI's LLM Trading Agent initialized!")
 
+    @property
+    def wallet_address(self):
+        """Wallet being traded, read on use so /update-keys applies right away"""
+        return os.getenv("WALLET_ADDRESS")
+
+    @property
+    def recommendations_df(self):
+        """All recommendations, folding buffered rows in with a single concat"""
+        with mutex:
+            if self._pending_rows:
+                self._recommendations_df = pd.concat(
+                    [
+                        self._recommendations_df,
+                        pd.DataFrame(self._pending_rows, columns=RECOMMENDATION_COLUMNS),
+                    ],
+                    ignore_index=True,
+                )
+                self._pending_rows = []
+            return self._recommendations_df
+
+    @recommendations_df.setter
+    def recommendations_df(self, df):
+        with mutex:
+            self._recommendations_df = df
+            self._rec_version += 1
+
+    def recommendations_json(self):
+        """Recommendations as JSON bytes, serialized at most once per change"""
+        with self._rec_cache_lock:
+            version = self._rec_version
+            if self._rec_cache is None or self._rec_cache[0] != version:
+                payload = self.recommendations_df.to_json(
+                    orient="records", date_format="iso", double_precision=6
+                )
+                self._rec_cache = (version, payload.encode())
+            return self._rec_cache[1]
+
+    @retry(
+        retry=retry_if_exception_type(anthropic.RateLimitError),
+        wait=wait_exponential(multiplier=1, max=60),
+        stop=stop_after_attempt(5),
+        reraise=True,
+    )
+    async def _create_message(self, **params):
+        """Send a Claude request once it fits within the shared rate limits"""
+        await anthropic_limiter.acquire(params)
+        return await self._client().messages.create(**params)
+
+    def _client(self):
+        """Async Claude client for the running event loop.
+
+        The trading thread and the API server each run their own loop, and an
+        httpx connection pool can't be shared across loops, so each loop gets
+        its own client that is reused for every call made on it.
+        """
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            # HTTP/2 multiplexes concurrent requests over pooled connections
+            http_client = anthropic.DefaultAsyncHttpxClient(
+                http2=True,
+                limits=httpx.Limits(
+                    max_connections=AI_MAX_CONNECTIONS,
+                    max_keepalive_connections=AI_MAX_CONNECTIONS // 2,
+                    keepalive_expiry=60,
+                ),
+                timeout=60,
+            )
+            client = self._clients[loop] = anthropic.AsyncAnthropic(
+                api_key=self.api_key, http_client=http_client
+            )
+        return client
+
+    async def aclose(self):
+        """Close the Claude client of the running event loop, if it has one"""
+        client = self._clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.close()
+
+    def _cleanup_temp_data(self):
+        """Remove cached OHLCV files, skipping the scan if the folder is untouched"""
+        if os.stat("temp_data").st_mtime == self._last_cleanup_mtime:
+            return
+        for path in glob.iglob(os.path.join("temp_data", "*_latest.*")):
+            os.unlink(path)
+        self._last_cleanup_mtime = os.stat("temp_data").st_mtime
+
+    def _monitored_tokens(self, ttl=MONITORED_TOKENS_TTL_SECONDS):
+        """Tokens owned by the wallet, re-fetched at most once every `ttl` seconds"""
+        fetched_at, address, tokens = self._monitored_tokens_cache
+        now = time.time()
+        wallet_address = self.wallet_address
+        if now - fetched_at > ttl or address != wallet_address:
+            tokens = get_wallet_owned_tokens(wallet_address)
+            self._monitored_tokens_cache = (now, wallet_address, tokens)
+        return tokens
+
+    def _cached_response(self, key):
+        """Return a still-fresh Claude response for this cache key, if any"""
+        cached = self._response_cache.get(key)
+        if cached and time.time() - cached[0] < AI_RESPONSE_CACHE_MINUTES * 60:
+            return cached[1]
+        return None
+
+    def _cache_response(self, key, response):
+        """Remember a Claude response, dropping entries that have expired"""
+        now = time.time()
+        self._response_cache = {
+            k: v
+            for k, v in self._response_cache.items()
+            if now - v[0] < AI_RESPONSE_CACHE_MINUTES * 60
+        }
+        self._response_cache[key] = (now, response)
+
+    def _add_recommendation(self, row):
+        """Buffer a recommendation row until recommendations_df is next read"""
+        with mutex:
+            index = len(self._recommendations_df) + len(self._pending_rows)
+            self._pending_rows.append(row)
+            self._rec_version += 1
+            # A stopped agent keeps the row in memory only
+            if not self._recommendations_fp.closed:
+                record = {"row": index, **row}
+                self._recommendations_fp.write(json.dumps(record) + "\n")
+
+    def _save_recommendations(self, rows, status=None):
+        """Set the given rows' status, if any, and append their state to disk"""
+        with mutex:
+            df = self._recommendations_df
+            if status is not None:
+                df.loc[rows, "status"] = status
+            self._rec_version += 1
+            for index in rows:
+                if self._recommendations_fp.closed:
+                    break
+                record = {"row": int(index), **df.loc[index].to_dict()}
+                self._recommendations_fp.write(json.dumps(record) + "\n")
+
     def log(
         self, message: str, *ignore: str, also_print: bool = True, role="assistant"
     ):
-        from anthropic.types import TextBlock
-
         """Log a message and optionally print it"""
+        # Entries are always stored as strings so they serialize as-is
         if isinstance(message, pd.DataFrame):
             message = message.to_string()
-        if isinstance(message, TextBlock):
+        elif isinstance(message, TextBlock):
             message = message.text
-        self.logs.append({"role": role, "time": time.time(), "message": message})
+        elif not isinstance(message, str):
+            message = str(message)
+        entry = {"role": role, "time": time.time(), "message": message}
+        self.logs.append(entry)
         if also_print:
             print(message)
-        self.save_logs()
-
-    def save_logs(self):
-        """
-        Save all logs from self.logs to a JSON file in the runs/ folder.
-        The file name includes a timestamp so it won't be overwritten.
-        """
-        import json
-        import os
+        self._append_log(entry)
 
+    def _append_log(self, entry):
+        """Append a single log entry as a JSON line to the run's log file"""
         with mutex:
-            # If there are no logs, you might not want to save an empty file
-            if not self.logs:
-                return
+            # A stopped agent keeps the entry in memory only
+            if not self._log_fp.closed:
+                self._log_fp.write(orjson.dumps(entry) + b"\n")
+
+    def _signals_dump(self, signals):
+        """Compact JSON for a set of strategy signals, dumped once per cycle"""
+        cached = self._signals_dump_cache.get(id(signals))
+        if cached is None:
+            # Keep a reference to the signals so their id can't be reused
+            dump = json.dumps(signals, separators=(",", ":"), default=str)
+            cached = self._signals_dump_cache[id(signals)] = (signals, dump)
+        return cached[1]
+
+    def _analysis_request(self, market_data):
+        """Build the Claude request parameters for analyzing one token"""
+        # Prepare strategy context
+        strategy_context = NO_STRATEGY_CONTEXT
+        if "strategy_signals" in market_data:
+            strategy_context = "Strategy Signals Available:\n" + self._signals_dump(
+                market_data["strategy_signals"]
+            )
 
-            for index, log in enumerate(self.logs):
-                if isinstance(log, pd.DataFrame):
-                    self.logs[index] = log.to_string()
+        # Static instructions go in the cached system block, per-token data last
+        content = "".join(
+            [
+                strategy_context,
+                "\n\nMarket Data to Analyze:\n",
+                summarize_ohlcv(market_data),
+            ]
+        )
+        return {
+            "model": AI_SCREEN_MODEL,
+            "max_tokens": AI_SCREEN_MAX_TOKENS,
+            "temperature": AI_TEMPERATURE,
+            "stop_sequences": ["\n\n\n"],
+            "system": TRADING_SYSTEM,
+            "messages": [{"role": "user", "content": content}],
+        }
+
+    def _record_analysis(self, token, response):
+        """Parse Claude's analysis for a token and add it to the recommendations"""
+        # Parse the response - handle both string and list responses
+        response = response_text(response)
+
+        # Only the first non-empty line decides, words like "Sell" further
+        # down are part of the reasoning
+        first_line = next((line for line in response.splitlines() if line.strip()), "")
+        match = ACTION_RE.match(first_line)
+        action = match.group(1) if match else "NOTHING"
+
+        # Extract confidence from a line like "Confidence: 75%"
+        match = CONFIDENCE_RE.search(response)
+        if match:
+            confidence = int(match.group(1))
+        else:
+            confidence = 50  # Default if not found
+            self.log(
+                f"⚠️ No confidence in the analysis for {token[:4]}, "
+                f"using the default of {confidence}%"
+            )
 
-            # Ensure the runs/ folder exists
-            os.makedirs("runs", exist_ok=True)
-            # Create a file name that includes the current time
-            file_name = f"runs/{self.run_id}_logs.json"
-            # Write logs to JSON
-            with open(file_name, "w") as f:
-                json.dump(self.logs, f, indent=2)
-            print(f"✅ Logs saved to {file_name}")
+        # Add to recommendations DataFrame with proper reasoning
+        newline = response.find("\n")
+        reasoning = (
+            response[newline + 1 :]
+            if newline != -1
+            else "No detailed reasoning provided"
+        )
+        self._add_recommendation(
+            {
+                "token": token,
+                "action": action,
+                "confidence": confidence,
+                "reasoning": reasoning,
+                "status": "pending",
+            }
+        )
+
+        self.log(f"🎯 Coffee AI's AI Analysis Complete for {token[:4]}!")
+        return response
+
+    def _record_analysis_error(self, token, error):
+        """Still add to DataFrame on error, but mark as NOTHING with 0 confidence"""
+        self.log(f"❌ Error in AI analysis: {str(error)}")
+        self._add_recommendation(
+            {
+                "token": token,
+                "action": "NOTHING",
+                "confidence": 0,
+                "reasoning": f"Error during analysis: {str(error)}",
+                "status": "pending",
+            }
+        )
+
+    def _reusable_analysis(self, token, market_data, key):
+        """Return a previous analysis when the token's market hasn't really moved"""
+        # Same (rounded) market data as a recent analysis
+        cached = self._cached_response(key)
+        if cached is not None:
+            self.log(f"♻️ Reusing recent analysis for {token[:4]}")
+            return cached
+
+        # Price and volume both within thresholds of the last analyzed candle
+        features = last_close_and_volume(market_data)
+        if features is None or token not in self._last_features:
+            return None
+        close, volume = features
+        last_close, last_volume, response = self._last_features[token]
+        price_move = abs(close - last_close) / last_close if last_close else 1
+        volume_move = abs(volume - last_volume) / last_volume if last_volume else 1
+        if price_move < PRICE_MOVE_THRESHOLD and volume_move < VOL_MOVE_THRESHOLD:
+            self.log(
+                f"😴 No significant move for {token[:4]} "
+                f"(price {price_move:.2%}, volume {volume_move:.2%}), "
+                "carrying the last analysis forward"
+            )
+            return response
+        return None
+
+    def _remember_analysis(self, token, market_data, key, response):
+        """Keep a fresh analysis around for reuse by later cycles"""
+        self._cache_response(key, response)
+        features = last_close_and_volume(market_data)
+        if features is not None:
+            self._last_features[token] = (*features, response)
 
-    def analyze_market_data(self, token, market_data):
+    async def analyze_market_data(self, token, market_data):
         """Analyze market data using Claude"""
         try:
             # Skip analysis for excluded tokens
@@ -179,104 +575,95 @@ class TradingAgent:
                 self.log(f"⚠️ Skipping analysis for excluded token: {token}")
                 return None
 
-            # Prepare strategy context
-            strategy_context = ""
-            if "strategy_signals" in market_data:
-                strategy_context = f"""
-                                    Strategy Signals Available:
-                                    {json.dumps(market_data["strategy_signals"], indent=2)}
-                                    """
-            else:
-                strategy_context = "No strategy signals available."
+            key = market_data_fingerprint(token, market_data)
+            previous = self._reusable_analysis(token, market_data, key)
+            if previous is not None:
+                return self._record_analysis(token, previous)
 
-            message = self.client.messages.create(
-                model=AI_MODEL,
-                max_tokens=AI_MAX_TOKENS,
-                temperature=AI_TEMPERATURE,
-                messages=[
-                    {
-                        "role": "user",
-                        "content": f"{TRADING_PROMPT.format(strategy_context=strategy_context)}\n\nMarket Data to Analyze:\n{market_data}",
-                    }
-                ],
+            message = await self._create_message(
+                **self._analysis_request(market_data)
             )
+            response = self._record_analysis(token, message.content)
+            self._remember_analysis(token, market_data, key, response)
+            return response
 
-            # Parse the response - handle both string and list responses
-            response = message.content
-            if isinstance(response, list):
-                # Extract text from TextBlock objects if present
-                response = "\n".join(
-                    [
-                        item.text if hasattr(item, "text") else str(item)
-                        for item in response
-                    ]
-                )
+        except Exception as e:
+            print_exc()
+            self._record_analysis_error(token, e)
+            return None
+
+    async def analyze_market_data_batch(self, market_data):
+        """Analyze all tokens in a single Message Batches job and wait for it to end"""
+        analyses = {}
+        keys = {}
+        requests = []
+        for token, data in market_data.items():
+            # Skip analysis for excluded tokens
+            if token in EXCLUDED_TOKENS:
+                self.log(f"⚠️ Skipping analysis for excluded token: {token}")
+                analyses[token] = None
+                continue
 
-            lines = response.split("\n")
-            action = lines[0].strip() if lines else "NOTHING"
+            keys[token] = market_data_fingerprint(token, data)
+            previous = self._reusable_analysis(token, data, keys[token])
+            if previous is not None:
+                analyses[token] = self._record_analysis(token, previous)
+                continue
+            requests.append({"custom_id": token, "params": self._analysis_request(data)})
 
-            # Extract confidence from the response (assuming it's mentioned as a percentage)
-            confidence = 0
-            for line in lines:
-                if "confidence" in line.lower():
-                    # Extract number from string like "Confidence: 75%"
-                    try:
-                        confidence = int("".join(filter(str.isdigit, line)))
-                    except:
-                        confidence = 50  # Default if not found
-
-            # Add to recommendations DataFrame with proper reasoning
-            reasoning = (
-                "\n".join(lines[1:])
-                if len(lines) > 1
-                else "No detailed reasoning provided"
-            )
-            self.recommendations_df = pd.concat(
-                [
-                    self.recommendations_df,
-                    pd.DataFrame(
-                        [
-                            {
-                                "token": token,
-                                "action": action,
-                                "confidence": confidence,
-                                "reasoning": reasoning,
-                                "status": "pending",
-                            }
-                        ]
-                    ),
-                ],
-                ignore_index=True,
-            )
+        if not requests:
+            return analyses
 
-            self.log(f"🎯 Coffee AI's AI Analysis Complete for {token[:4]}!")
-            return response
+        try:
+            batches = self._client().messages.batches
+            batch = await batches.create(requests=requests)
+            self.log(f"📦 Submitted batch {batch.id} with {len(requests)} analyses")
+            deadline = time.monotonic() + BATCH_MAX_WAIT_MINUTES * 60
+            while batch.processing_status != "ended":
+                # Wakes up right away when the agent is stopped
+                stopped = await asyncio.to_thread(
+                    self._stop_event.wait, BATCH_POLL_INTERVAL_SECONDS
+                )
+                if stopped or time.monotonic() > deadline:
+                    reason = (
+                        "agent stopped"
+                        if stopped
+                        else f"not done after {BATCH_MAX_WAIT_MINUTES} minutes"
+                    )
+                    self.log(f"🛑 Cancelling batch {batch.id}: {reason}")
+                    try:
+                        await batches.cancel(batch.id)
+                    except Exception:
+                        print_exc()
+                    raise RuntimeError(f"batch {batch.id} cancelled, {reason}")
+                batch = await batches.retrieve(batch.id)
+
+            async for entry in await batches.results(batch.id):
+                token = entry.custom_id
+                if entry.result.type == "succeeded":
+                    analyses[token] = self._record_analysis(
+                        token, entry.result.message.content
+                    )
+                    self._remember_analysis(
+                        token, market_data[token], keys[token], analyses[token]
+                    )
+                else:
+                    self._record_analysis_error(
+                        token, f"batch request {entry.result.type}"
+                    )
+                    analyses[token] = None
 
         except Exception as e:
             print_exc()
-            self.log(f"❌ Error in AI analysis: {str(e)}")
-            # Still add to DataFrame even on error, but mark as NOTHING with 0 confidence
-            self.recommendations_df = pd.concat(
-                [
-                    self.recommendations_df,
-                    pd.DataFrame(
-                        [
-                            {
-                                "token": token,
-                                "action": "NOTHING",
-                                "confidence": 0,
-                                "reasoning": f"Error during analysis: {str(e)}",
-                                "status": "pending",
-                            }
-                        ]
-                    ),
-                ],
-                ignore_index=True,
-            )
-            return None
+            for request in requests:
+                if request["custom_id"] not in analyses:
+                    self._record_analysis_error(request["custom_id"], e)
+                    analyses[request["custom_id"]] = None
+
+        return analyses
 
-    def allocate_portfolio(self):
-        MONITORED_TOKENS = get_wallet_owned_tokens(os.getenv("WALLET_ADDRESS"))
+    async def allocate_portfolio(self):
+        MONITORED_TOKENS = self._monitored_tokens()
         """Get AI-recommended portfolio allocation"""
         try:
             self.log("\n💰 Calculating optimal portfolio allocation...", "cyan")
@@ -287,38 +674,24 @@ class TradingAgent:
             )
 
             # Get allocation from AI
-            message = self.client.messages.create(
+            message = await self._create_message(
                 model=AI_MODEL,
                 max_tokens=AI_MAX_TOKENS,
                 temperature=AI_TEMPERATURE,
+                system=ALLOCATION_SYSTEM,
                 messages=[
                     {
                         "role": "user",
-                        "content": f"""You are Coffee AI's Portfolio Allocation AI 
-                        Given:
+                        "content": f"""Given:
                         - Total portfolio size: ${usd_size}.00
                         - Maximum position size: ${max_position_size}.00 ({MAX_POSITION_PERCENTAGE}% of total)
-                        - Minimum cash (USDC) buffer: {CASH_PERCENTAGE}%
-                        - Available tokens: {MONITORED_TOKENS}
-                        - USDC Address: {USDC_ADDRESS}
-
-                        Provide a portfolio allocation that:
-                        1. Never exceeds max position size per token
-                        2. Maintains minimum cash buffer
-                        3. Returns allocation as a JSON object with token addresses as keys and USD amounts as values
-                        4. Uses exact USDC address: {USDC_ADDRESS} for cash allocation
-                        Say I had $10 in USDC
-                        Example format:
-                        {{
-                            "token_address": 1.5,
-                            "{USDC_ADDRESS}": 8.5
-                        }}""",
+                        - Available tokens: {MONITORED_TOKENS}""",
                     }
                 ],
             )
 
             # Parse the response
-            allocations = self.parse_allocation_response((message.content))
+            allocations = await self.parse_allocation_response(message.content)
             if not allocations:
                 return None
 
@@ -348,39 +721,52 @@ class TradingAgent:
             self.log(f"❌ Error in portfolio allocation: {str(e)}", "red")
             return None
 
+    def _execute_entry(self, token, amount, current_position):
+        """Bring a single position up to its target allocation"""
+        self.log(f"\n🎯 Processing allocation for {token}...")
+
+        try:
+            target_allocation = amount
+
+            self.log(f"🎯 Target allocation: ${target_allocation:.2f} USD")
+            self.log(f"📊 Current position: ${current_position:.2f} USD")
+
+            if current_position < target_allocation:
+                self.log(f"✨ Executing entry for {token}")
+                n.ai_entry(token, amount, logger=self.log)
+                self.log(f"✅ Entry complete for {token}")
+            else:
+                self.log(f"⏸️ Position already at target size for {token}")
+
+        except Exception as e:
+            print_exc()
+            self.log(f"❌ Error executing entry for {token}: {str(e)}")
+
     def execute_allocations(self, allocation_dict):
         """Execute the allocations using AI entry for each position"""
         try:
             self.log("\n🚀 Coffee AI executing portfolio allocations...")
 
+            entries = []
             for token, amount in allocation_dict.items():
                 # Skip USDC and other excluded tokens
                 if token in EXCLUDED_TOKENS:
                     self.log(f"💵 Keeping ${amount:.2f} in {token}")
                     continue
+                entries.append((token, amount))
 
-                self.log(f"\n🎯 Processing allocation for {token}...")
-
-                try:
-                    # Get current position value
-                    current_position = n.get_token_balance_usd(token, logger=self.log)
-                    target_allocation = amount
-
-                    self.log(f"🎯 Target allocation: ${target_allocation:.2f} USD")
-                    self.log(f"📊 Current position: ${current_position:.2f} USD")
-
-                    if current_position < target_allocation:
-                        self.log(f"✨ Executing entry for {token}")
-                        n.ai_entry(token, amount, logger=self.log)
-                        self.log(f"✅ Entry complete for {token}")
-                    else:
-                        self.log(f"⏸️ Position already at target size for {token}")
+            if not entries:
+                return
 
-                except Exception as e:
-                    print_exc()
-                    self.log(f"❌ Error executing entry for {token}: {str(e)}")
+            # Get current position values with a single wallet lookup
+            balances = n.get_token_balances_usd(
+                [token for token, _ in entries], self.wallet_address, logger=self.log
+            )
 
-                time.sleep(2)  # Small delay between entries
+            # Entries are independent, so run a few at once within the RPC rate limit
+            with ThreadPoolExecutor(max_workers=ENTRY_MAX_WORKERS) as executor:
+                for token, amount in entries:
+                    executor.submit(self._execute_entry, token, amount, balances[token])
 
         except Exception as e:
             self.log(f"❌ Error executing allocations: {str(e)}")
@@ -390,17 +776,22 @@ class TradingAgent:
         """Check and exit positions based on SELL or NOTHING recommendations"""
         self.log("\n🔄 Checking for positions to exit...", "white", "on_blue")
 
-        for index, row in self.recommendations_df.iterrows():
-            token = row["token"]
-            status = row["status"]
-            # Skip excluded tokens (USDC and SOL)
-            if token in EXCLUDED_TOKENS or status != "pending":
-                continue
+        df = self.recommendations_df
+        # Skip excluded tokens (USDC and SOL) and already handled recommendations
+        pending = df[(df["status"] == "pending") & (~df["token"].isin(EXCLUDED_TOKENS))]
+        if pending.empty:
+            return
 
-            action = row["action"]
+        # Check which positions we have with a single wallet lookup
+        balances = n.get_token_balances_usd(
+            pending["token"].unique().tolist(), self.wallet_address, logger=self.log
+        )
+        executed_idx, failed_idx = [], []
 
-            # Check if we have a position
-            current_position = n.get_token_balance_usd(token, logger=self.log)
+        for row in pending.itertuples():
+            token = row.token
+            action = row.action
+            current_position = balances[token]
 
             if current_position > 0 and action in ["SELL"]:
                 self.log(
@@ -417,26 +808,32 @@ class TradingAgent:
                     )
                     n.chunk_kill(token, max_usd_order_size, slippage, logger=self.log)
                     self.log("✅ Successfully closed position", "white", "on_green")
-                    self.recommendations_df.at[index, "status"] = "executed"
+                    balances[token] = 0.0
+                    executed_idx.append(row.Index)
                 except Exception as e:
                     self.log(f"❌ Error closing position: {str(e)}", "white", "on_red")
-                    self.recommendations_df.at[index, "status"] = "failed"
+                    failed_idx.append(row.Index)
             elif current_position > 0:
                 self.log(
                     f"✨ Keeping position for {token} (${current_position:.2f}) - AI recommends {action}",
                     "white",
                     "on_blue",
                 )
-                self.recommendations_df.at[index, "status"] = "executed"
+                executed_idx.append(row.Index)
 
-    def parse_allocation_response(self, response):
-        response = str(response)
-        print(f"{response=}")
+        if executed_idx:
+            self._save_recommendations(executed_idx, status="executed")
+        if failed_idx:
+            self._save_recommendations(failed_idx, status="failed")
+
+    async def parse_allocation_response(self, response):
         """Parse the AI's allocation response and handle both string and TextBlock formats"""
+        # Handle TextBlock format from Claude 3
+        response = response_text(response)
+        print(f"{response=}")
         try:
-            # Handle TextBlock format from Claude 3
-
-            # Find the JSON block between curly braces
+            # Find the JSON block between curly braces; this also drops any
+            # markdown fences around it, and json.loads tolerates whitespace
             start = response.find("{")
             end = response.rfind("}") + 1
             if start == -1 or end == 0:
@@ -444,21 +841,18 @@ class TradingAgent:
 
             json_str = response[start:end]
 
-            # More aggressive JSON cleaning
-            json_str = (
-                json_str.replace("\n", "")  # Remove newlines
-                .replace("    ", "")  # Remove indentation
-                .replace("\t", "")  # Remove tabs
-                .replace("\\n", "")  # Remove escaped newlines
-                .replace(" ", "")  # Remove all spaces
-                .strip()
-            )  # Remove leading/trailing whitespace
-
-            self.log("\n🧹 Cleaned JSON string:")
+            self.log("\n🧹 Extracted JSON string:")
             self.log(json_str)
 
-            # Parse the cleaned JSON
-            allocations = json.loads(json_str)
+            try:
+                allocations = orjson.loads(json_str)
+            except orjson.JSONDecodeError as e:
+                # Fix syntax slips (trailing commas, comments, quoting) locally
+                # before paying for another round-trip to Claude
+                self.log(f"🔧 Repairing malformed JSON locally: {str(e)}")
+                allocations = json_repair.loads(json_str)
+            if not isinstance(allocations, dict):
+                raise ValueError("Allocation response is not a JSON object")
 
             self.log("\n📊 Parsed allocations:")
             for token, amount in allocations.items():
@@ -475,6 +869,8 @@ class TradingAgent:
 
         except Exception as e:
             self.log(f"❌ Error parsing allocation response: {str(e)}")
+            if not LLM_REPAIR_ENABLED:
+                return None
             try:
                 # Construct a prompt to fix the response structure
                 fix_prompt = f"""
@@ -487,17 +883,14 @@ class TradingAgent:
                                     "USDC_ADDRESS": remaining_cash
                                 }}
                             """
-                fix_message = self.client.messages.create(
+                fix_message = await self._create_message(
                     model=AI_MODEL,
-                    max_tokens=AI_MAX_TOKENS,
+                    max_tokens=LLM_REPAIR_MAX_TOKENS,
                     temperature=AI_TEMPERATURE,
+                    system="Return ONLY JSON",
                     messages=[{"role": "user", "content": fix_prompt}],
                 )
-                fixed_response = (
-                    fix_message.content.text
-                    if hasattr(fix_message.content, "text")
-                    else fix_message.content
-                )
+                fixed_response = response_text(fix_message.content)
                 self.log("🔍 Fixed response received:")
                 self.log(fixed_response)
 
@@ -507,16 +900,7 @@ class TradingAgent:
                 if start == -1 or end == 0:
                     raise ValueError("No JSON object found in fixed response")
 
-                fixed_json_str = fixed_response[start:end]
-                fixed_json_str = (
-                    fixed_json_str.replace("\n", "")
-                    .replace("    ", "")
-                    .replace("\t", "")
-                    .replace("\\n", "")
-                    .replace(" ", "")
-                    .strip()
-                )
-                allocations = json.loads(fixed_json_str)
+                allocations = orjson.loads(fixed_response[start:end])
 
                 self.log("\n📊 Parsed fixed allocations:")
                 for token, amount in allocations.items():
@@ -536,8 +920,9 @@ class TradingAgent:
                 self.log(f"❌ Error parsing fixed allocation response again: {str(e2)}")
                 return None
 
-    def process_user_input(self, user_input):
-        MONITORED_TOKENS = get_wallet_owned_tokens(os.getenv("WALLET_ADDRESS"))
+    async def process_user_input(self, user_input):
+        # Runs on the API server's event loop, so keep blocking lookups off it
+        MONITORED_TOKENS = await asyncio.to_thread(self._monitored_tokens)
         """
         Convert the free-form user input into a structured recommendation.
         If the input is trivial (e.g., 'No need, this is fine') or yields an empty JSON,
@@ -547,9 +932,29 @@ class TradingAgent:
             log_length = len(self.logs)
             self.log(user_input, role="user")
 
-            self.log("🔄 Collecting token details")
-            token_info = collect_all_tokens(MONITORED_TOKENS, logger=self.log)
-            history = self.logs
+            # Reuse the current cycle's features instead of refetching OHLCV
+            features = self._cycle_features
+            if not features:
+                self.log("🔄 Collecting token details")
+                market_data = await asyncio.to_thread(
+                    collect_all_tokens, MONITORED_TOKENS, logger=self.log
+                )
+                features = {
+                    token: ohlcv_arrays(data) for token, data in market_data.items()
+                }
+            token_info = "\n".join(
+                f"{token}:\n{summarize_ohlcv(arrays)}"
+                for token, arrays in features.items()
+                if token in MONITORED_TOKENS
+            )
+            # Only the recent tail of the conversation, without bulky entries
+            # such as logged DataFrames
+            history = [
+                entry
+                for entry in self.logs[-MAX_HISTORY_MSGS * 2 :]
+                if len(str(entry.get("message", ""))) < MAX_HISTORY_MSG_CHARS
+            ][-MAX_HISTORY_MSGS:]
+            history = json.dumps(history, separators=(",", ":"))
             fix_prompt = f"""
                         You are a trading recommendation assistant.
                         Your task is to convert the following unstructured free-form user input into a structured trading recommendation.
@@ -572,7 +977,7 @@ class TradingAgent:
                         Only output the JSON object, with no additional text.
                         {{"token":"xxx", "action":"BUY", "confidence":100, "reasoning":"User provided recommendation."}}
                         """
-            message = self.client.messages.create(
+            message = await self._create_message(
                 model=AI_MODEL,
                 max_tokens=AI_MAX_TOKENS,
                 temperature=AI_TEMPERATURE,
@@ -604,10 +1009,7 @@ class TradingAgent:
                     "confidence": confidence,
                     "reasoning": reasoning,
                 }
-                self.recommendations_df = pd.concat(
-                    [self.recommendations_df, pd.DataFrame([new_row])],
-                    ignore_index=True,
-                )
+                self._add_recommendation(new_row)
                 self.log(f"🔄 Added structured user recommendation: {new_row}")
             else:
                 self.log("ℹ️ No valid action found in recommendation.")
@@ -620,16 +1022,31 @@ class TradingAgent:
 
     def run(self):
         """Run the trading agent (implements BaseAgent interface)"""
-        print("Starting cycle", self, self.__stop)
+        # One trading loop per agent, so stop() only has one thread to wait for
+        if self.tid and self.tid.is_alive():
+            return
+        print("Starting cycle", self)
         self.tid = self._run_trading_cycle()
 
     @run_in_thread
     def _run_trading_cycle(self, strategy_signals=None):
-        MONITORED_TOKENS = get_wallet_owned_tokens(os.getenv("WALLET_ADDRESS"))
-        print("Starting cycle", self, self.__stop)
-        """Run one complete trading cycle"""
-        while not self.__stop:
+        """Run the trading loop on this thread's own event loop"""
+
+        async def main():
             try:
+                await self._trading_loop(strategy_signals)
+            finally:
+                # The event loop ends with this thread, so close its client too
+                await self.aclose()
+
+        asyncio.run(main())
+
+    async def _trading_loop(self, strategy_signals=None):
+        """Run trading cycles until the agent is stopped"""
+        while not self._stop_event.is_set():
+            try:
+                self._signals_dump_cache.clear()
+                MONITORED_TOKENS = self._monitored_tokens()
                 self.status = AgentStatus.TRADING
                 current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
                 self.log(
@@ -638,15 +1055,17 @@ class TradingAgent:
 
                 # Collect OHLCV data for all tokens
                 self.log("📊 Collecting market data...", "white", "on_blue")
-                market_data = collect_all_tokens(MONITORED_TOKENS, logger=self.log)
+                market_data = {
+                    token: ohlcv_arrays(data)
+                    for token, data in collect_all_tokens(
+                        MONITORED_TOKENS, logger=self.log
+                    ).items()
+                }
+                # Shared with process_user_input until the next cycle
+                self._cycle_features = market_data
 
-                # Analyze each token's data
+                # Include strategy signals in analysis if available
                 for token, data in market_data.items():
-                    self.log(
-                        f"\n🤖 AI Agent Analyzing Token: {token}", "white", "on_green"
-                    )
-
-                    # Include strategy signals in analysis if available
                     if strategy_signals and token in strategy_signals:
                         self.log(
                             f"📊 Including {len(strategy_signals[token])} strategy signals in analysis",
@@ -654,7 +1073,37 @@ class TradingAgent:
                         )
                         data["strategy_signals"] = strategy_signals[token]
 
-                    analysis = self.analyze_market_data(token, data)
+                # Analyze each token's data
+                if USE_BATCH_API:
+                    self.log(
+                        f"\n🤖 AI Agent Analyzing {len(market_data)} Tokens in a batch",
+                        "white",
+                        "on_green",
+                    )
+                    analyses = await self.analyze_market_data_batch(market_data)
+                else:
+                    semaphore = asyncio.Semaphore(AI_MAX_WORKERS)
+
+                    async def analyze(token, data):
+                        async with semaphore:
+                            return await self.analyze_market_data(token, data)
+
+                    for token in market_data:
+                        self.log(
+                            f"\n🤖 AI Agent Analyzing Token: {token}",
+                            "white",
+                            "on_green",
+                        )
+                    results = await asyncio.gather(
+                        *[analyze(token, data) for token, data in market_data.items()],
+                        return_exceptions=True,
+                    )
+                    analyses = {
+                        token: None if isinstance(result, BaseException) else result
+                        for token, result in zip(market_data, results)
+                    }
+
+                for token, analysis in analyses.items():
                     self.log(f"\n📈 Analysis for contract: {token}")
                     self.log(analysis)
                     self.log("\n" + "=" * 50 + "\n")
@@ -675,7 +1124,7 @@ class TradingAgent:
                     "white",
                     "on_blue",
                 )
-                allocation = self.allocate_portfolio()
+                allocation = await self.allocate_portfolio()
 
                 if allocation:
                     self.log(
@@ -692,9 +1141,7 @@ class TradingAgent:
                 # Clean up temp data
                 self.log("\n🧹 Cleaning up temporary data...", "white", "on_blue")
                 try:
-                    for file in os.listdir("temp_data"):
-                        if file.endswith("_latest.csv"):
-                            os.remove(os.path.join("temp_data", file))
+                    self._cleanup_temp_data()
                     self.log("✨ Temp data cleaned successfully!", "white", "on_green")
                 except Exception as e:
                     self.log(
@@ -709,9 +1156,6 @@ class TradingAgent:
                     "on_blue",
                 )
             finally:
-                self.recommendations_df.to_csv(
-                    f"runs/{self.run_id}_recommendations_latest.csv", index=False
-                )
                 self.log(json.dumps(self.recommendations_df.to_dict()))
                 self.status = AgentStatus.SLEEPING
 
@@ -721,8 +1165,10 @@ class TradingAgent:
                 "white",
                 "on_green",
             )
-            if not self.__stop:
-                time.sleep(SLEEP_BETWEEN_RUNS_MINUTES * 60)
+            if await asyncio.to_thread(
+                self._stop_event.wait, SLEEP_BETWEEN_RUNS_MINUTES * 60
+            ):
+                break
 
 
 # def main():
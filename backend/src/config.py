@@ -3,7 +3,7 @@ USDC_ADDRESS = "EPjFWdd5AufqSSqeM2qN1xzybapC8G4wEGGkZwyTDt1v"  # Never trade or
 SOL_ADDRESS = "So11111111111111111111111111111111111111111"  # Never trade or close
 
 # Create a list of addresses to exclude from trading/closing
-EXCLUDED_TOKENS = [USDC_ADDRESS, SOL_ADDRESS]
+EXCLUDED_TOKENS = frozenset([USDC_ADDRESS, SOL_ADDRESS])
 
 # # # Token List for Trading 📋
 # MONITORED_TOKENS = [
@@ -19,6 +19,7 @@ EXCLUDED_TOKENS = [USDC_ADDRESS, SOL_ADDRESS]
 # ]
 
 MONITORED_TOKENS = []
+MONITORED_TOKENS_TTL_SECONDS = 60  # How long to reuse the wallet's token list before re-fetching
 
 
 
@@ -65,6 +66,8 @@ MAX_GAIN_PERCENT = 5  # Maximum gain as percentage (e.g., 50 = 50% gain)
 slippage = 199  # 500 = 5% and 50 = .5% slippage
 PRIORITY_FEE = 100000  # ~0.02 USD at current SOL prices
 orders_per_open = 3  # Multiple orders for better fill rates
+ENTRY_MAX_WORKERS = 4  # Allocation entries executed at once
+RPC_CALLS_PER_SECOND = 5  # Max Solana RPC / Jupiter / Birdeye calls per second while trading
 
 # Market maker settings 📊
 buy_under = 0.0946
@@ -74,6 +77,7 @@ sell_over = 1
 DAYSBACK_4_DATA = 3
 DATA_TIMEFRAME = "1H"  # 1m, 3m, 5m, 15m, 30m, 1H, 2H, 4H, 6H, 8H, 12H, 1D, 3D, 1W, 1M
 SAVE_OHLCV_DATA = False  # Set to True to save data permanently, False will only use temp data during run
+OHLCV_MAX_WORKERS = 8  # Tokens fetched from Birdeye at once, keep within its rate limits
 
 # AI Model Settings 🤖
 AI_MODEL = "claude-3-haiku-20240307"  # Model Options:
@@ -82,6 +86,23 @@ AI_MODEL = "claude-3-haiku-20240307"  # Model Options:
 # - claude-3-opus-20240229 (Most powerful Claude model)
 AI_MAX_TOKENS = 1024  # Max tokens for response
 AI_TEMPERATURE = 0.7  # Creativity vs precision (0-1)
+# Per-token screening only needs an action and short reasoning, so it runs on a
+# fast model with a small budget; AI_MODEL is kept for allocation and user input
+AI_SCREEN_MODEL = "claude-3-haiku-20240307"
+AI_SCREEN_MAX_TOKENS = 256
+MAX_HISTORY_MSGS = 20  # Recent log entries sent with user feedback
+MAX_HISTORY_MSG_CHARS = 2000  # Longer log entries are left out of that history
+LLM_REPAIR_ENABLED = True  # Ask Claude to fix allocation JSON that can't be repaired locally
+LLM_REPAIR_MAX_TOKENS = 200  # Budget for that fix-up call
+USE_BATCH_API = False  # Submit per-token analyses as one Message Batches job (50% cheaper, higher latency)
+BATCH_POLL_INTERVAL_SECONDS = 10  # How often to check whether a submitted batch has ended
+BATCH_MAX_WAIT_MINUTES = 60  # Cancel a batch that hasn't ended by then (batches can take up to 24h)
+AI_MAX_WORKERS = 8  # Max per-token analyses in flight at once when not batching
+AI_REQUESTS_PER_MINUTE = 40  # Anthropic tier request limit shared by all calls
+AI_TOKENS_PER_MINUTE = 16000  # Anthropic tier input token limit shared by all calls
+AI_MAX_CONNECTIONS = 64  # Pooled HTTP/2 connections to Anthropic per event loop
+PRICE_MOVE_THRESHOLD = 0.005  # Skip re-analysis while the last close moved less than this fraction
+VOL_MOVE_THRESHOLD = 0.25  # ...and the last candle's volume moved less than this fraction
 
 # Trading Strategy Agent Settings - MAY NOT BE USED YET 1/5/25
 ENABLE_STRATEGIES = True  # Set this to True to use strategies
@@ -89,6 +110,7 @@ STRATEGY_MIN_CONFIDENCE = 0.7  # Minimum confidence to act on strategy signals
 
 # Sleep time between main agent runs
 SLEEP_BETWEEN_RUNS_MINUTES = 15  # How long to sleep between agent runs 🕒
+AI_RESPONSE_CACHE_MINUTES = SLEEP_BETWEEN_RUNS_MINUTES + 5  # Reuse an analysis while a token's (rounded) market data is unchanged, must outlast the sleep to ever hit
 
 # in our nice_funcs in token over view we look for minimum trades last hour
 MIN_TRADES_LAST_HOUR = 2
@@ -1,5 +1,9 @@
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 import pandas as pd
 from termcolor import cprint
 
@@ -12,7 +16,109 @@ def get_wallet_owned_tokens(wallet_address: str):
     response: pd.DataFrame = n.fetch_wallet_holdings_og(wallet_address)
     if response.empty:
         return []
-    return [x for x in response["Mint Address"].tolist() if x not in EXCLUDED_TOKENS]
+    mints = response["Mint Address"]
+    return mints[~mints.isin(EXCLUDED_TOKENS)].tolist()
+
+
+# Folder collected OHLCV is kept in when configured, created once up front
+if SAVE_OHLCV_DATA:
+    os.makedirs("data", exist_ok=True)
+
+TIMEFRAME_UNIT_SECONDS = {"m": 60, "H": 3600, "D": 86400, "W": 604800, "M": 2592000}
+
+# Last fetched frame per (token, days_back, timeframe), with its fetch time
+_CACHE: dict[tuple, tuple[float, pd.DataFrame]] = {}
+_CACHE_LOCK = threading.Lock()
+
+
+def _timeframe_to_seconds(timeframe):
+    """Length of one candle in seconds, e.g. "15m" -> 900, "4H" -> 14400"""
+    return int(timeframe[:-1]) * TIMEFRAME_UNIT_SECONDS[timeframe[-1]]
+
+
+def _last_timestamp(data: pd.DataFrame):
+    """Timestamp of the newest candle, or None if the frame has no time column"""
+    if "Datetime (UTC)" not in data.columns:
+        return None
+    return data["Datetime (UTC)"].iloc[-1]
+
+
+OHLCV_COLUMNS = {
+    "open": "Open",
+    "high": "High",
+    "low": "Low",
+    "close": "Close",
+    "volume": "Volume",
+}
+
+
+def ohlcv_arrays(data: pd.DataFrame):
+    """Pull a token's OHLCV columns out into a dict of float numpy arrays"""
+    return {
+        key: data[column].to_numpy(dtype=float)
+        for key, column in OHLCV_COLUMNS.items()
+        if column in data.columns
+    }
+
+
+def _sma(values, length):
+    """Latest simple moving average of the last `length` values, or NaN"""
+    if len(values) < length:
+        return np.nan
+    return np.convolve(values, np.ones(length) / length, mode="valid")[-1]
+
+
+def _rsi(close, length=14):
+    """Latest RSI using Wilder's smoothing, or NaN if there's too little data"""
+    if len(close) <= length:
+        return np.nan
+    delta = np.diff(close)
+    gains = np.where(delta > 0, delta, 0.0)
+    losses = np.where(delta < 0, -delta, 0.0)
+    # Exponential weights with alpha = 1/length, newest candle weighted most
+    weights = (1 - 1 / length) ** np.arange(len(delta))[::-1]
+    avg_gain = weights @ gains
+    avg_loss = weights @ losses
+    if avg_loss == 0:
+        return 100.0 if avg_gain > 0 else 50.0
+    return 100 - 100 / (1 + avg_gain / avg_loss)
+
+
+def _side(value, reference):
+    if np.isnan(value) or np.isnan(reference):
+        return "n/a"
+    return "above" if value > reference else "below"
+
+
+def summarize_ohlcv(arr_dict):
+    """Condense a token's OHLCV arrays into a 10-line summary for the LLM"""
+    close = arr_dict.get("close")
+    if close is None or len(close) == 0:
+        return "No OHLCV data available"
+    volume = arr_dict.get("volume", np.full(len(close), np.nan))
+    high = arr_dict.get("high", close)
+    low = arr_dict.get("low", close)
+
+    last = close[-1]
+    ma20 = _sma(close, 20)
+    ma40 = _sma(close, 40)
+    rsi = _rsi(close)
+    avg_volume = _sma(volume, min(20, len(volume)))
+    change = (last / close[0] - 1) * 100 if close[0] else np.nan
+    return "\n".join(
+        [
+            f"Candles: {len(close)} x {DATA_TIMEFRAME}",
+            f"Last close: {last:.6g}",
+            f"Change over period: {change:+.2f}%",
+            f"Period high/low: {np.max(high):.6g} / {np.min(low):.6g}",
+            f"MA20: {ma20:.6g} (price {_side(last, ma20)})",
+            f"MA40: {ma40:.6g} (price {_side(last, ma40)})",
+            f"MA20 vs MA40: {_side(ma20, ma40)}",
+            f"RSI(14): {rsi:.1f}",
+            f"Last volume: {volume[-1]:.6g} (20-candle avg {avg_volume:.6g})",
+            "Recent closes: " + ", ".join(f"{c:.6g}" for c in close[-5:]),
+        ]
+    )
 
 
 def collect_token_data(
@@ -27,6 +133,16 @@ def collect_token_data(
     logger(f"fetching data for {token}", "white", "on_blue")
 
     try:
+        # Reuse the last fetch while its newest candle is still current
+        key = (token, days_back, timeframe)
+        with _CACHE_LOCK:
+            cached = _CACHE.get(key)
+        if cached is not None and time.time() - cached[0] < (
+            _timeframe_to_seconds(timeframe) / 2
+        ):
+            logger(f"using cached data for {token[:4]}", "white", "on_green")
+            return cached[1]
+
         # Get data from Birdeye
         data = n.get_data(token, days_back, timeframe)
 
@@ -44,18 +160,27 @@ def collect_token_data(
             "on_blue",
         )
 
-        # Save data if configured
-        if SAVE_OHLCV_DATA:
-            save_path = f"data/{token}_latest.csv"
-        else:
-            save_path = f"temp_data/{token}_latest.csv"
-
-        # Ensure directory exists
-        os.makedirs(os.path.dirname(save_path), exist_ok=True)
-
-        # Save to CSV
-        data.to_csv(save_path)
-        logger(f"cached data for {token[:4]}", "white", "on_green")
+        with _CACHE_LOCK:
+            _CACHE[key] = (time.time(), data)
+
+        # Save data permanently if configured; get_data already keeps a
+        # Parquet copy in temp_data for the current run
+        if not SAVE_OHLCV_DATA:
+            return data
+
+        # Nothing new to save if no candle was added since the last fetch
+        last_timestamp = _last_timestamp(data)
+        if (
+            cached is not None
+            and last_timestamp is not None
+            and _last_timestamp(cached[1]) == last_timestamp
+        ):
+            return data
+
+        data.to_parquet(
+            f"data/{token}_latest.parquet", compression="zstd", engine="pyarrow"
+        )
+        logger(f"saved data for {token[:4]}", "white", "on_green")
 
         return data
 
@@ -79,10 +204,14 @@ def collect_all_tokens(user_tokens, logger=None):
         "on_blue",
     )
 
-    for token in user_tokens:
-        data = collect_token_data(token, logger=logger)
-        if data is not None:
-            market_data[token] = data
+    # Fetches are independent I/O, so run them side by side
+    with ThreadPoolExecutor(max_workers=OHLCV_MAX_WORKERS) as executor:
+        results = executor.map(
+            lambda token: collect_token_data(token, logger=logger), user_tokens
+        )
+        for token, data in zip(user_tokens, results):
+            if data is not None:
+                market_data[token] = data
 
     logger(
         "completed market data collection!",
@@ -1,10 +1,13 @@
+import asyncio
 import atexit
 import datetime
+import functools
 import json
 import os
 import pprint
 import re as reggie
 import shutil
+import threading
 import time
 from datetime import datetime, timedelta
 
@@ -12,7 +15,9 @@ import pandas as pd
 import pandas_ta as ta
 import requests
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
 from termcolor import cprint
+from urllib3.util.retry import Retry
 
 from src.config import *
 
@@ -32,6 +37,73 @@ sample_address = "2yXTyarttn2pTZ6cwt4DqmrRuBw1G7pmFv9oT6MStdKP"
 
 BASE_URL = "https://public-api.birdeye.so/defi"
 
+# Shared session so Birdeye, Jupiter and RPC calls reuse pooled connections
+SESSION = requests.Session()
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=16,
+        pool_maxsize=16,
+        max_retries=Retry(total=3, backoff_factor=0.2),
+    ),
+)
+
+
+class TokenBucket:
+    """Thread-safe token bucket allowing `capacity` acquisitions per `period` seconds."""
+
+    def __init__(self, capacity, period=60.0):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _reserve(self, amount):
+        """Take `amount` tokens if available, else return how long to wait for them"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return 0
+            return (amount - self.tokens) / self.rate
+
+    def acquire(self, amount=1):
+        """Block until `amount` tokens are available, then take them"""
+        amount = min(amount, self.capacity)
+        while wait := self._reserve(amount):
+            time.sleep(wait)
+
+    async def acquire_async(self, amount=1):
+        """Wait without blocking the event loop until `amount` tokens are taken"""
+        amount = min(amount, self.capacity)
+        while wait := self._reserve(amount):
+            await asyncio.sleep(wait)
+
+
+# Shared cap on the Solana RPC, Jupiter and Birdeye calls made while trading,
+# so concurrent entries and exits can't flood them
+RPC_LIMITER = TokenBucket(RPC_CALLS_PER_SECOND, period=1.0)
+
+
+def rpc_limited(calls=1):
+    """Take `calls` tokens from RPC_LIMITER before each call of the function"""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            RPC_LIMITER.acquire(calls)
+            return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
 # Create temp directory and register cleanup
 os.makedirs("temp_data", exist_ok=True)
 
@@ -71,7 +143,7 @@ def token_overview(address):
     overview_url = f"{BASE_URL}/token_overview?address={address}"
     headers = {"X-API-KEY": BIRDEYE_API_KEY}
 
-    response = requests.get(overview_url, headers=headers)
+    response = SESSION.get(overview_url, headers=headers)
     result = {}
 
     if response.status_code == 200:
@@ -201,7 +273,7 @@ def token_security_info(address):
     headers = {"X-API-KEY": BIRDEYE_API_KEY}
 
     # Sending a GET request to the API
-    response = requests.get(url, headers=headers)
+    response = SESSION.get(url, headers=headers)
 
     if response.status_code == 200:
         # Parse the JSON response
@@ -228,7 +300,7 @@ def token_creation_info(address):
     headers = {"X-API-KEY": BIRDEYE_API_KEY}
 
     # Sending a GET request to the API
-    response = requests.get(url, headers=headers)
+    response = SESSION.get(url, headers=headers)
 
     if response.status_code == 200:
         # Parse the JSON response
@@ -238,11 +310,11 @@ def token_creation_info(address):
         print("Failed to retrieve token creation info:", response.status_code)
 
 
+@rpc_limited(3)  # quote, swap, send_raw_transaction
 def market_buy(token, amount, slippage, logger=None):
     import base64
     import json
 
-    import requests
     from solana.rpc.api import Client
     from solana.rpc.types import TxOpts
     from solders.keypair import Keypair
@@ -266,12 +338,12 @@ def market_buy(token, amount, slippage, logger=None):
     if not http_client:
         raise ValueError("🚨 RPC_ENDPOINT not found in environment variables!")
 
-    quote = requests.get(
+    quote = SESSION.get(
         f"https://quote-api.jup.ag/v6/quote?inputMint={QUOTE_TOKEN}&outputMint={token}&amount={amount}&slippageBps={SLIPPAGE}"
     ).json()
     # print(quote)
 
-    txRes = requests.post(
+    txRes = SESSION.post(
         "https://quote-api.jup.ag/v6/swap",
         headers={"Content-Type": "application/json"},
         data=json.dumps(
@@ -293,11 +365,11 @@ def market_buy(token, amount, slippage, logger=None):
     logger(f"https://solscan.io/tx/{str(txId)}")
 
 
+@rpc_limited(3)  # quote, swap, send_raw_transaction
 def market_sell(QUOTE_TOKEN, amount, slippage, logger=None):
     import base64
     import json
 
-    import requests
     from solana.rpc.api import Client
     from solana.rpc.types import TxOpts
     from solders.keypair import Keypair
@@ -321,11 +393,11 @@ def market_sell(QUOTE_TOKEN, amount, slippage, logger=None):
     if not http_client:
         raise ValueError("🚨 RPC_ENDPOINT not found in environment variables!")
 
-    quote = requests.get(
+    quote = SESSION.get(
         f"https://quote-api.jup.ag/v6/quote?inputMint={QUOTE_TOKEN}&outputMint={token}&amount={amount}&slippageBps={SLIPPAGE}"
     ).json()
     # print(quote)
-    txRes = requests.post(
+    txRes = SESSION.post(
         "https://quote-api.jup.ag/v6/swap",
         headers={"Content-Type": "application/json"},
         data=json.dumps(
@@ -387,15 +459,17 @@ def get_data(address, days_back_4_data, timeframe, logger=None):
     time_from, time_to = get_time_range(days_back_4_data)
 
     # Check temp data first
-    temp_file = f"temp_data/{address}_latest.csv"
+    temp_file = f"temp_data/{address}_latest.parquet"
     if os.path.exists(temp_file):
         logger(f"cached data for {address[:4]}")
-        return pd.read_csv(temp_file)
+        return pd.read_parquet(temp_file, engine="pyarrow")
 
     url = f"https://public-api.birdeye.so/defi/ohlcv?address={address}&type={timeframe}&time_from={time_from}&time_to={time_to}"
 
     headers = {"X-API-KEY": BIRDEYE_API_KEY}
-    response = requests.get(url, headers=headers)
+    # Only a cache miss reaches Birdeye, so only it counts against the limit
+    RPC_LIMITER.acquire()
+    response = SESSION.get(url, headers=headers)
     if response.status_code == 200:
         json_response = response.json()
         items = json_response.get("data", {}).get("items", [])
@@ -435,8 +509,9 @@ def get_data(address, days_back_4_data, timeframe, logger=None):
 
         logger(f"Ready! Processing {len(df)} candles... 🎯")
 
-        # Always save to temp for current run
-        df.to_csv(temp_file)
+        # Always save to temp for current run, Parquet is much faster to
+        # write and re-read than CSV
+        df.to_parquet(temp_file, compression="zstd", engine="pyarrow")
         logger(f"cached data for {address[:4]}")
 
         # Calculate indicators
@@ -458,6 +533,7 @@ def get_data(address, days_back_4_data, timeframe, logger=None):
         return pd.DataFrame()
 
 
+@rpc_limited()
 def fetch_wallet_holdings_og(address, logger=None):
     BIRDEYE_API_KEY = get_bird_eye_key()
     API_KEY = (
@@ -474,7 +550,7 @@ def fetch_wallet_holdings_og(address, logger=None):
 
     url = f"https://public-api.birdeye.so/v1/wallet/token_list?wallet={address}"
     headers = {"x-chain": "solana", "X-API-KEY": API_KEY}
-    response = requests.get(url, headers=headers)
+    response = SESSION.get(url, headers=headers)
 
     if response.status_code == 200:
         json_response = response.json()
@@ -521,11 +597,12 @@ def fetch_wallet_token_single(address, token_mint_address, logger=None):
     return df
 
 
+@rpc_limited()
 def token_price(address):
     BIRDEYE_API_KEY = get_bird_eye_key()
     url = f"https://public-api.birdeye.so/defi/price?address={address}"
     headers = {"X-API-KEY": BIRDEYE_API_KEY}
-    response = requests.get(url, headers=headers)
+    response = SESSION.get(url, headers=headers)
     price_data = response.json()
 
     print(price_data)
@@ -536,6 +613,7 @@ def token_price(address):
         return None
 
 
+@rpc_limited()
 def get_position(token_mint_address):
     """
     Fetches the balance of a specific token given its mint address from a DataFrame.
@@ -579,8 +657,8 @@ def get_position(token_mint_address):
         return 0  # Indicating no balance found
 
 
+@rpc_limited()
 def get_decimals(token_mint_address):
-    import requests
 
     # Solana Mainnet RPC endpoint
     url = "https://api.mainnet-beta.solana.com/"
@@ -597,7 +675,7 @@ def get_decimals(token_mint_address):
     )
 
     # Make the request to Solana RPC
-    response = requests.post(url, headers=headers, data=payload)
+    response = SESSION.post(url, headers=headers, data=payload)
     response_json = response.json()
 
     # Parse the response to extract the number of decimals
@@ -1396,6 +1474,29 @@ def get_token_balance_usd(token_mint_address, logger=None):
         return 0.0
 
 
+def get_token_balances_usd(token_mint_addresses, address, logger=None):
+    """Get the USD value of several token positions with a single wallet lookup"""
+    if not logger:
+
+        def logger(msg, ignore=None):
+            print(msg)
+
+    balances = dict.fromkeys(token_mint_addresses, 0.0)
+    try:
+        df = fetch_wallet_holdings_og(address, logger=logger)
+        df = df[df["Mint Address"].isin(balances)].drop_duplicates("Mint Address")
+        for token_mint_address, usd_value in zip(df["Mint Address"], df["USD Value"]):
+            balances[token_mint_address] = float(usd_value)
+
+    except Exception as e:
+        logger(f"❌ Error getting token balances: {str(e)}")
+
+    for token_mint_address, usd_value in balances.items():
+        if not usd_value:
+            logger(f"🔍 No position found for {token_mint_address[:8]}")
+    return balances
+
+
 # if  __name__ == "__main__" :
 #     hold = fetch_wallet_holdings_og(address)
 #     print(f"{hold=}")
@@ -1,49 +1,138 @@
+import asyncio
 import json
 import os
-import random
+import re
+import secrets
+import stat
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from os import environ
 
+import anyio
+import orjson
 import uvicorn
-from dotenv import find_dotenv, set_key
+from dotenv import find_dotenv
+from dotenv.parser import parse_stream
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, Response
 from pydantic import BaseModel
 
 env_path = find_dotenv()
-print(f"{env_path=}")
 
 # Import your TradingAgent class and any relevant modules
+from src import nice_funcs as n
 from src.agents.trading_agent import TradingAgent
 
+# Ensure the runs folder exists, once at startup
+os.makedirs("runs", exist_ok=True)
 
-def generate_unique_run_id(runs_folder="runs"):
+
+def load_run_ids(runs_folder="runs"):
     """
-    Generate a unique 10-digit run ID such that no file in the runs folder
-    starts with that number.
+    Collect the IDs of all runs in the runs folder, keyed by file name prefix.
     """
-    # Ensure the folder exists
-    os.makedirs(runs_folder, exist_ok=True)
+    with os.scandir(runs_folder) as entries:
+        return {entry.name.split("_")[0] for entry in entries}
+
+
+# Run IDs are 16 hex characters from generate_unique_run_id, or the 10-digit
+# numbers it used to hand out
+_RUN_ID_RE = re.compile(r"^(?:[0-9a-f]{16}|\d{10})$")
 
+# Known run IDs, read from disk once and kept up to date as runs are created
+_run_ids: set[str] = load_run_ids()
+
+
+def generate_unique_run_id(runs_folder="runs"):
+    """
+    Generate a unique run ID of 16 random hex characters, claimed by
+    exclusively creating the run's log file.
+    """
     while True:
-        run_id = random.randint(10**9, 10**10 - 1)  # Generates a 10-digit number
-        run_id_str = str(run_id)
-        existing_files = os.listdir(runs_folder)
-        if not any(fname.startswith(run_id_str) for fname in existing_files):
-            with open(runs_folder + "/" + run_id_str + "_logs.json", "w") as f:
-                f.write("[]")
-            return f"{run_id}"
+        run_id = secrets.token_hex(8)
+        try:
+            # Exclusive create fails on the (vanishingly rare) collision
+            open(os.path.join(runs_folder, f"{run_id}_logs.jsonl"), "xb").close()
+        except FileExistsError:
+            continue
+        _run_ids.add(run_id)
+        return run_id
 
 
-def get_runs_ids(runs_folder="runs"):
+def get_runs_ids():
     """
     Get a list of all runs in the runs folder.
     """
-    # Ensure the folder exists
-    os.makedirs(runs_folder, exist_ok=True)
-    files = os.listdir(runs_folder)
-    names = list(set([file.split("_")[0] for file in files]))
-    return names
+    return list(_run_ids)
+
+
+def read_run_logs(run_id):
+    """
+    Read a run's log entries from disk.
+    """
+    path = os.path.join("runs", f"{run_id}_logs.jsonl")
+    if os.path.exists(path):
+        with open(path, "rb") as file:
+            return [orjson.loads(line) for line in file if line.strip()]
+    # Runs from before logs were stored as JSON lines
+    with open(os.path.join("runs", f"{run_id}_logs.json"), "r") as file:
+        return json.load(file)
+
+
+def _env_line(key, value):
+    """A KEY='value' line, quoted the way dotenv's set_key writes it"""
+    return "{}='{}'\n".format(key, value.replace("'", "\\'"))
+
+
+def save_keys(keys):
+    """
+    Persist the given keys to the .env file in a single write, leaving
+    every other line (comments, blank lines, export prefixes) as it is.
+    """
+    path = env_path or ".env"
+    lines = []
+    written = set()
+    # New files hold private keys, so keep them to the owner
+    mode = 0o600
+    if os.path.exists(path):
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+        with open(path, "r") as file:
+            for binding in parse_stream(file):
+                original = binding.original.string
+                if binding.key not in keys:
+                    lines.append(original)
+                    continue
+                # Blank lines before a binding are part of its original text
+                stripped = original.lstrip()
+                prefix = "export " if stripped.startswith("export ") else ""
+                lines.append(
+                    original[: len(original) - len(stripped)]
+                    + prefix
+                    + _env_line(binding.key, keys[binding.key])
+                )
+                written.add(binding.key)
+    if lines and not lines[-1].endswith("\n"):
+        lines[-1] += "\n"
+    lines.extend(
+        _env_line(key, value) for key, value in keys.items() if key not in written
+    )
+
+    # Swap the new file in whole, so readers never see a half-written .env
+    folder = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile(
+        "w", dir=folder, prefix=".env.", delete=False
+    ) as file:
+        file.writelines(lines)
+    try:
+        os.chmod(file.name, mode)
+        os.replace(file.name, path)
+    except OSError:
+        os.unlink(file.name)
+        raise
 
 
 # Create a single, global instance of the TradingAgent
@@ -56,12 +145,34 @@ def update_agent(run_id):
     if agent:
         agent.stop()
     agent = TradingAgent(run_id=run_id)
+    _run_ids.add(run_id)
     return agent
 
 
-# agent.setup(run_id="***")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Set up shared resources at startup and release them at shutdown.
+    The agent itself is only created once a run is picked, so no run is
+    made up at startup.
+    """
+    # A single worker keeps agent switches and cycle starts in request order
+    app.state.executor = ThreadPoolExecutor(max_workers=1)
+    yield
+    if agent:
+        # Waits for a cycle in progress, so keep it off the event loop
+        await asyncio.to_thread(agent.stop)
+        await agent.aclose()
+    app.state.executor.shutdown()
+    n.SESSION.close()
+
+
 # Initialize FastAPI
-app = FastAPI(title="Coffee Auto Trader")
+app = FastAPI(
+    title="Coffee Auto Trader",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan,
+)
 
 app.add_middleware(
     CORSMiddleware,
@@ -70,10 +181,12 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Compress larger bodies such as recommendations and run logs
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
 
 
 @app.get("/")
-def read_root():
+async def read_root():
     """
     Basic health check or greeting endpoint.
     """
@@ -81,27 +194,26 @@ def read_root():
 
 
 @app.get("/recommendations")
-def get_recommendations():
+async def get_recommendations():
     """
     Returns the current DataFrame of recommendations as JSON.
     """
-    # Convert the DataFrame to a list of dictionaries
-    data = agent.recommendations_df.to_dict(orient="records")
-    return JSONResponse(content=data)
+    # Cached by the agent until the recommendations change
+    payload = agent.recommendations_json()
+    return Response(content=payload, media_type="application/json")
 
 
 @app.get("/create_new_run")
-def start_new_run():
+async def start_new_run():
     """
     Starts a new trading run with a unique run ID.
     """
-    global agent
-    unique_run_id = generate_unique_run_id()
+    unique_run_id = await anyio.to_thread.run_sync(generate_unique_run_id)
     return {"run_id": unique_run_id, "status": "ready"}
 
 
 @app.get("/runs")
-def get_runs():
+async def get_runs():
     """
     Returns a list of all runs in the runs folder.
     """
@@ -110,16 +222,18 @@ def get_runs():
 
 
 @app.get("/runs/{run_id}/logs")
-def get_run_logs(run_id: str):
+async def get_run_logs(run_id: str):
     """
     Returns the logs for a specific run.
     """
+    not_found = ORJSONResponse({"error": "Run ID not found"}, status_code=404)
+    # Reject malformed or unknown IDs before they get near a file path
+    if not _RUN_ID_RE.fullmatch(run_id) or run_id not in _run_ids:
+        return not_found
     try:
-        with open(f"runs/{run_id}_logs.json", "r") as file:
-            logs = json.load(file)
-
+        logs = await anyio.to_thread.run_sync(read_run_logs, run_id)
     except FileNotFoundError:
-        return {"error": "Run ID not found"}
+        return not_found
     return {"logs": logs, "status": agent.status if agent else "IDLE"}
 
 
@@ -128,16 +242,22 @@ class runTradingCycleReq(BaseModel):
 
 
 @app.post("/run_cycle")
-def run_trading_cycle(req: runTradingCycleReq):
+async def run_trading_cycle(req: runTradingCycleReq):
     """
     Triggers the trading cycle in the background, so the client doesn't have to wait.
     """
     # Even with an error it mostly returns logs
     run_id = req.run_id
+    executor = app.state.executor
     try:
         if run_id:
-            agent = update_agent(run_id)
-        agent.run()
+            previous = agent
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(executor, update_agent, run_id)
+            if previous:
+                # Its client for user feedback lives on this loop, close it here
+                await previous.aclose()
+        executor.submit(agent.run)
     except Exception:
         return {"status": "Error", "logs": []}
     return {"status": "Started"}
@@ -148,14 +268,14 @@ class UserFeedbackReq(BaseModel):
 
 
 @app.post("/user_feedback")
-def user_feedback(req: UserFeedbackReq):
+async def user_feedback(req: UserFeedbackReq):
     """
     Endpoint to accept free-form user feedback or recommendations.
     The TradingAgent will parse and incorporate them into the next cycle.
     """
     feedback = req.feedback
     try:
-        logs = agent.process_user_input(feedback)
+        logs = await agent.process_user_input(feedback)
         return {
             "status": "Feedback processed, will be incorporated in the next run",
             "logs": logs,
@@ -172,30 +292,38 @@ class Keys(BaseModel):
 
 
 @app.post("/update-keys")
-def update_keys(req: Keys):
-    if req.ANTHROPIC_KEY:
-        set_key(env_path, "ANTHROPIC_KEY", req.ANTHROPIC_KEY)
-        environ["ANTHROPIC_KEY"] = req.ANTHROPIC_KEY
-    if req.BIRDEYE_API_KEY:
-        set_key(env_path, "BIRDEYE_API_KEY", req.BIRDEYE_API_KEY)
-        environ["BIRDEYE_API_KEY"] = req.BIRDEYE_API_KEY
-    if req.SOLANA_PRIVATE_KEY:
-        set_key(env_path, "SOLANA_PRIVATE_KEY", req.SOLANA_PRIVATE_KEY)
-        environ["SOLANA_PRIVATE_KEY"] = req.SOLANA_PRIVATE_KEY
-    if req.WALLET_ADDRESS:
-        set_key(env_path, "WALLET_ADDRESS", req.WALLET_ADDRESS)
-        environ["WALLET_ADDRESS"] = req.WALLET_ADDRESS
+async def update_keys(req: Keys):
+    keys = {key: value for key, value in req.model_dump().items() if value}
+    await anyio.to_thread.run_sync(save_keys, keys)
+    environ.update(keys)
     return {"ok": True}
 
 
+_REQUIRED_KEYS = (
+    "BIRDEYE_API_KEY",
+    "ANTHROPIC_KEY",
+    "SOLANA_PRIVATE_KEY",
+    "WALLET_ADDRESS",
+)
+
+
 @app.get("/has-keys")
-def has_keys():
-    k = ["BIRDEYE_API_KEY", "ANTHROPIC_KEY", "SOLANA_PRIVATE_KEY", "WALLET_ADDRESS"]
-    has = [x for x in k if environ.get(x)]
-    missing = [x for x in k if not environ.get(x)]
-    return {"has": has, "missing": missing}
+async def has_keys():
+    has, missing = [], []
+    for key in _REQUIRED_KEYS:
+        (has if environ.get(key) else missing).append(key)
+    return ORJSONResponse({"has": has, "missing": missing})
 
 
 if __name__ == "__main__":
-    # Run the server using uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    print(f"{env_path=}")
+    # Run the server using uvicorn on uvloop (not available on Windows) and
+    # httptools. Stay on a single worker: the agent lives in this process, so
+    # extra workers would each get their own agent.
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=8000,
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools",
+    )
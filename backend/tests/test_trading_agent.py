@@ -0,0 +1,42 @@
+import pytest
+
+from src.agents.trading_agent import ACTION_RE
+
+
+@pytest.mark.parametrize(
+    "line, action",
+    [
+        ("BUY", "BUY"),
+        ("SELL - momentum is fading", "SELL"),
+        ("NOTHING", "NOTHING"),
+        ("**SELL**", "SELL"),
+        ("## BUY", "BUY"),
+        ("> `NOTHING`", "NOTHING"),
+        ("Recommendation: BUY", "BUY"),
+        ("**Action:** SELL", "SELL"),
+        ("1. BUY", "BUY"),
+        ("1) SELL", "SELL"),
+        ("2. **NOTHING**", "NOTHING"),
+        ("1. Action: SELL", "SELL"),
+    ],
+)
+def test_action_re_accepts(line, action):
+    match = ACTION_RE.match(line)
+    assert match and match.group(1) == action
+
+
+@pytest.mark.parametrize(
+    "line",
+    [
+        "buy",
+        "Sell",
+        "BUYING",
+        "NOTHINGNESS",
+        "I would BUY here",
+        "1 BUY",
+        "1.5 BUY",
+        "",
+    ],
+)
+def test_action_re_rejects(line):
+    assert ACTION_RE.match(line) is None
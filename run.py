@@ -1,9 +1,14 @@
 #!/usr/bin/env python3
 
+import os
+import shutil
+import signal
+import subprocess
 import sys
 from argparse import ArgumentParser
+from functools import lru_cache
 from pathlib import Path
-from subprocess import Popen, DEVNULL
+from subprocess import Popen
 from os import chdir, environ
 from os.path import dirname
 
@@ -15,9 +20,11 @@ def nice_try(fn):
         print(f"<IGNORE> An error occured: {e}.\n</IGNORE> ")
 
 
-def run(args: str | list) -> Popen:
+def run(args: str | list, **kwargs) -> Popen:
     print(f"running: {args}")
-    proc = Popen(args.split() if isinstance(args, str) else args, env=environ.copy())
+    proc = Popen(
+        args.split() if isinstance(args, str) else args, env=environ.copy(), **kwargs
+    )
     return proc
 
 
@@ -25,12 +32,20 @@ def wait(args: str | list) -> int:
     return run(args).wait()
 
 
+def replace_with(args: str):
+    """Replace this process with the command, so no extra interpreter lingers"""
+    if os.name == "nt":
+        # exec on Windows starts a new process and exits, losing the console
+        sys.exit(wait(args))
+    # Flush now, exec discards anything still buffered
+    print(f"running: {args}", flush=True)
+    os.execvp(args.split()[0], args.split())
+
+
+@lru_cache(maxsize=None)
 def has_uv():
-    try:
-        x = Popen(["uv", "version"], stdout=DEVNULL).wait() == 0
-        return x
-    except:
-        return False
+    # Already running under `uv run`, or uv is on the PATH; no need to spawn it
+    return "UV" in environ or shutil.which("uv") is not None
 
 
 def is_docker():
@@ -52,33 +67,40 @@ def parse_args():
 def frontend():
     chdir(FRONTEND_DIR)
     wait("pnpm i")
-    wait("pnpm run dev")
+    replace_with("pnpm run dev")
 
 
 def server():
     chdir(BACKEND_DIR)
-    wait("uv run python -m src.server")
+    replace_with("uv run python -m src.server")
 
 
 def run_everything():
+    # Each child leads its own process group, so Ctrl+C can reach
+    # everything it spawns (uv, node, ...)
+    if os.name == "nt":
+        kwargs = {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP}
+    else:
+        kwargs = {"start_new_session": True}
     proc = [
-        run("python3 run.py --action=server"),
-        run("python3 run.py --action=frontend"),
+        run("python3 run.py --action=server", **kwargs),
+        run("python3 run.py --action=frontend", **kwargs),
     ]
     try:
         for p in proc:
             p.wait()
     except KeyboardInterrupt:
-        import signal
-
-        p.send_signal(signal.SIGINT)
-        p.wait()
+        for p in proc:
+            if os.name == "nt":
+                p.send_signal(signal.CTRL_BREAK_EVENT)
+            else:
+                nice_try(lambda: os.killpg(p.pid, signal.SIGINT))
+        for p in proc:
+            p.wait()
     print("\nkilled")
 
 
 def install_uv():
-    import os
-
     print("Please run:\n")
     if os.name == "nt":
         print(